@@ -1,16 +1,57 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+import pyarrow as pa
 import os
 import re
-import uuid
+import orjson
+import time
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # --- Configuration ---
 # BACKEND_BASE_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:5000")
 BACKEND_BASE_URL = os.getenv("BACKEND_URL", "http://15.235.9.166:5002")
 QUERY_URL = f"{BACKEND_BASE_URL}/query"
 DISCOVER_CONTENT_URL = f"{BACKEND_BASE_URL}/discover-content"
+BOOTSTRAP_URL = f"{BACKEND_BASE_URL}/bootstrap"
 HEALTH_CHECK_URL = f"{BACKEND_BASE_URL}/"
+# How long to skip backend calls after a connection failure.
+CIRCUIT_OPEN_SECONDS = 30
+# Number of chat messages rendered on each rerun before older ones are hidden.
+MAX_RENDERED_MESSAGES = 20
+# Result sets below this many rows are kept as Arrow tables instead of DataFrames.
+SMALL_RESULT_ROWS = 200
+# How long a backend health check result is reused, and how often the status refreshes.
+HEALTH_CHECK_SECONDS = 30
+
+# --- HTTP Session ---
+# A single pooled session so every backend call reuses keep-alive connections
+# instead of paying a fresh TCP/TLS handshake per request. Held in Streamlit's
+# resource cache so reruns and hot-reloads share the same pool. The no-retry
+# variant is for probes that must fail fast.
+@st.cache_resource
+def get_http_session(retry=True):
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(total=3, connect=1, backoff_factor=0.3, status_forcelist=[502, 503, 504]) if retry else 0
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({'Content-Type': 'application/json'})
+    return session
+
+# One alternation pattern for format_sql; LEFT JOIN must come before JOIN.
+_SQL_KW_RE = re.compile(
+    r'\b(SELECT|FROM|WHERE|LEFT\s+JOIN|JOIN|ON|GROUP\s+BY|ORDER\s+BY|LIMIT)\b',
+    re.IGNORECASE
+)
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -19,14 +60,30 @@ st.set_page_config(
     page_icon="🤖"
 )
 
-# --- Helper Functions (No changes needed here) ---
-def make_api_request(url, method="GET", json_data=None, timeout=60):
+# --- Helper Functions ---
+@st.cache_resource
+def _get_circuit():
+    # Process-wide rather than in st.session_state: the backend is shared by every
+    # user, and the health check runs on a worker thread with no session attached.
+    return {"backend_down_until": 0.0}
+
+def make_api_request(url, method="GET", json_data=None, timeout=(3, 60), check_circuit=True,
+                     session_id=None, retry=True):
+    # timeout is (connect, read) so an unreachable backend fails in seconds.
+    # session_id goes in a header so the backend can route before parsing the body.
+    circuit = _get_circuit()
+    if check_circuit and time.monotonic() < circuit["backend_down_until"]:
+        return None, "Connection Error: Backend marked offline, retrying shortly."
     try:
-        headers = {'Content-Type': 'application/json'}
+        session = get_http_session(retry)
+        headers = {'X-Session-Id': session_id} if session_id else None
         if method.upper() == "POST":
-            response = requests.post(url, json=json_data, timeout=timeout, headers=headers)
+            # The session already sends Content-Type: application/json
+            body = orjson.dumps(json_data) if json_data is not None else None
+            response = session.post(url, data=body, timeout=timeout, headers=headers)
         else:
-            response = requests.get(url, timeout=timeout, headers=headers)
+            response = session.get(url, timeout=timeout, headers=headers)
+        circuit["backend_down_until"] = 0.0
         response.raise_for_status()
         return response.json(), None
     except requests.exceptions.HTTPError as http_err:
@@ -38,26 +95,121 @@ def make_api_request(url, method="GET", json_data=None, timeout=60):
         except:
             return None, f"An HTTP error occurred: {http_err.response.text}"
     except requests.exceptions.ConnectionError:
+        circuit["backend_down_until"] = time.monotonic() + CIRCUIT_OPEN_SECONDS
         return None, "Connection Error: Backend is unreachable."
     except Exception as e:
         return None, f"An unexpected error occurred: {e}"
 
+@st.cache_resource
+def get_executor():
+    # Shared worker pool for overlapping independent backend calls.
+    return ThreadPoolExecutor(max_workers=4)
+
+def submit_background(fn, *args, **kwargs):
+    # Worker threads carry the caller's script context so the cached helpers
+    # they call (session, circuit) don't log missing-ScriptRunContext warnings.
+    ctx = get_script_run_ctx()
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+    return get_executor().submit(run)
+
+@st.cache_data(ttl=HEALTH_CHECK_SECONDS, show_spinner=False)
+def _check_backend(url):
+    # Cached so the status indicator doesn't cost an HTTP round-trip on every rerun.
+    # Always probes, so a recovered backend closes the circuit. No retries, so a
+    # dead backend costs one short timeout rather than several.
+    return make_api_request(url, timeout=(2, 5), check_circuit=False, retry=False)
+
+def build_results(results_list, columns=None):
+    # Returns a pyarrow Table or a DataFrame; st.dataframe accepts both.
+    if not results_list:
+        return None
+    first_keys = results_list[0].keys() if isinstance(results_list[0], dict) else None
+    if first_keys is None or any(
+        not isinstance(row, dict) or row.keys() != first_keys for row in results_list
+    ):
+        # Rows sent as plain lists, or dicts with differing keys; the paths below
+        # take column names from the first row, so let pandas handle these as before
+        return pd.DataFrame(results_list)
+    if len(results_list) < SMALL_RESULT_ROWS:
+        # st.dataframe serializes to Arrow anyway, so small results skip pandas.
+        try:
+            table = pa.Table.from_pylist(results_list)
+            return table.select(columns) if columns else table
+        except (pa.ArrowException, OverflowError, KeyError):
+            # e.g. mixed-type columns or integers outside int64 (BIGINT UNSIGNED)
+            pass
+    if columns:
+        return pd.DataFrame.from_records(results_list, columns=columns)
+    # SQL rows all share the same keys, so build column-wise instead of letting
+    # pandas walk every row dict.
+    data = {key: [row.get(key) for row in results_list] for key in results_list[0]}
+    return pd.DataFrame(data, copy=False)
+
 def format_sql(sql_query):
     if not isinstance(sql_query, str): return ""
-    keywords = ['SELECT', 'FROM', 'WHERE', 'JOIN', 'LEFT JOIN', 'ON', 'GROUP BY', 'ORDER BY', 'LIMIT']
-    for keyword in keywords:
-        sql_query = re.sub(rf'\b({keyword})\b', f'\n{keyword}', sql_query, flags=re.IGNORECASE)
-    return sql_query.strip()
+    return _SQL_KW_RE.sub(lambda m: '\n' + ' '.join(m.group(1).upper().split()), sql_query).strip()
+
+def append_message(role, text, sql=None, result=None):
+    # The chat history is stored column-wise: one list per field, indexed by message.
+    chat = st.session_state.chat
+    chat["role"].append(role)
+    chat["text"].append(text)
+    chat["sql"].append(sql)
+    # The SQL is formatted once here rather than on every rerender.
+    chat["sql_formatted"].append(format_sql(sql) if sql else "")
+    chat["result"].append(result)
+    return len(chat["role"]) - 1
+
+def display_content(i):
+    chat = st.session_state.chat
+    # Text is the user prompt, an error, or the assistant's summary
+    st.markdown(chat["text"][i])
+    if chat["sql"][i]:
+        with st.expander("View Generated SQL"):
+            st.code(chat["sql_formatted"][i], language="sql")
+    if chat["result"][i] is not None:
+        st.dataframe(chat["result"][i], use_container_width=True)
+
+def display_message(i):
+    with st.chat_message(st.session_state.chat["role"][i]):
+        display_content(i)
+
+def get_schema_digest():
+    # Collect the /bootstrap result once it has finished. Never wait on it: until
+    # then queries go out without a digest, which the backend treats as a miss.
+    future = st.session_state.get("bootstrap_future")
+    if future is not None and future.done():
+        del st.session_state["bootstrap_future"]
+        data, error = future.result()
+        if data and not error:
+            st.session_state.schema_digest = data.get("schema_digest")
+    return st.session_state.schema_digest
 
 def generate_session_id():
-    return f"st-session-{uuid.uuid4()}"
+    return "s-" + secrets.token_urlsafe(9)
 
 # --- Session State Initialization ---
 # The session now persists for the lifetime of the browser tab.
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+if "chat" not in st.session_state:
+    st.session_state.chat = {"role": [], "text": [], "sql": [], "sql_formatted": [], "result": []}
 if "session_id" not in st.session_state:
     st.session_state.session_id = generate_session_id()
+if "schema_digest" not in st.session_state:
+    # One round-trip on first load for the schema digest, which is sent with every
+    # query so the backend can skip re-embedding. It runs in the background so the
+    # page renders right away. Older backends without /bootstrap leave it as None.
+    st.session_state.schema_digest = None
+    st.session_state.bootstrap_future = submit_background(
+        make_api_request,
+        BOOTSTRAP_URL,
+        method="POST",
+        json_data={"session_id": st.session_state.session_id},
+        timeout=(2, 5),
+        session_id=st.session_state.session_id,
+        retry=False
+    )
 
 # --- Main Page Layout ---
 
@@ -73,6 +225,11 @@ with st.expander("Admin & Setup"):
                 st.error(f"Discovery Failed: {error}")
             else:
                 st.success(f"Discovery complete! {data.get('documents_added', 0)} documents indexed.")
+                # A fresh discovery supersedes bootstrap; no digest means the old one is stale
+                st.session_state.pop("bootstrap_future", None)
+                st.session_state.schema_digest = data.get("schema_digest")
+    if st.button("Force Refresh Backend Status"):
+        _check_backend.clear()
 
 # --- Main Chat Interface ---
 
@@ -80,25 +237,20 @@ with st.expander("Admin & Setup"):
 chat_container = st.container()
 
 with chat_container:
-    # Display the chat history from the session state
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            # For assistant messages, we might have structured content
-            if isinstance(message["content"], dict):
-                st.markdown(message["content"]["summary"])
-                if message["content"]["sql"]:
-                    with st.expander("View Generated SQL"):
-                        st.code(format_sql(message["content"]["sql"]), language="sql")
-                if not message["content"]["df"].empty:
-                    st.dataframe(message["content"]["df"], use_container_width=True)
-            else:
-                # For user messages or simple text responses
-                st.markdown(message["content"])
+    # Display the chat history from the session state. Only the most recent
+    # messages are rendered by default; older ones are rendered on request.
+    total = len(st.session_state.chat["role"])
+    first_recent = max(0, total - MAX_RENDERED_MESSAGES)
+    if first_recent and st.toggle(f"Show {first_recent} earlier messages", key="show_earlier_messages"):
+        for i in range(first_recent):
+            display_message(i)
+    for i in range(first_recent, total):
+        display_message(i)
 
 # The chat input box at the bottom of the page
 if prompt := st.chat_input("Ask a question about your data..."):
     # Add user message to history and display it immediately
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    append_message("user", prompt)
     with st.chat_message("user"):
         st.markdown(prompt)
 
@@ -107,33 +259,35 @@ if prompt := st.chat_input("Ask a question about your data..."):
         with st.spinner("🤖 Thinking..."):
             json_payload = {
                 "query": prompt,
-                "session_id": st.session_state.session_id
+                "session_id": st.session_state.session_id,
+                "schema_digest": get_schema_digest()
             }
-            response, error = make_api_request(QUERY_URL, method="POST", json_data=json_payload)
+            response, error = make_api_request(
+                QUERY_URL,
+                method="POST",
+                json_data=json_payload,
+                session_id=st.session_state.session_id
+            )
             
             if error:
                 st.error(error)
-                st.session_state.messages.append({"role": "assistant", "content": error})
+                append_message("assistant", error)
             elif response:
                 sql_query = response.get("sql_query")
                 results_list = response.get("results", [])
-                df = pd.DataFrame(results_list) if results_list else pd.DataFrame()
+                # Built once here and kept in the session state; empty results store nothing.
+                result = build_results(results_list, response.get("columns"))
                 
                 # Create a user-friendly text summary
                 summary_text = f"I found {len(results_list)} results."
                 if not results_list and "SELECT" in (sql_query or "").upper():
                     summary_text = "The query ran successfully, but returned no results."
                 
-                # Store the full response (text, SQL, and DataFrame) in the session state
-                assistant_response = {
-                    "summary": summary_text,
-                    "sql": sql_query,
-                    "df": df
-                }
-                st.session_state.messages.append({"role": "assistant", "content": assistant_response})
-                
-                # Rerun the script to display the new message from the session state
-                st.rerun()
+                # Store the full response (text, SQL, and results) in the session state
+                i = append_message("assistant", summary_text, sql_query, result)
+
+                # Display it in this run; the history loop picks it up on the next one
+                display_content(i)
 
 # --- Connection Status Indicator ---
 # This CSS places the status indicator in the bottom-left corner.
@@ -152,7 +306,12 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-# Check the backend status once per session and display it.
-_, error = make_api_request(HEALTH_CHECK_URL)
-status_text = "🟢 Backend Connected" if not error else "🔴 Backend Disconnected"
-st.markdown(f'<div class="status-indicator">{status_text}</div>', unsafe_allow_html=True)
+# The status text lives in a fragment, so its periodic refresh reruns only this
+# block instead of the whole script. The CSS above stays static.
+@st.fragment(run_every=HEALTH_CHECK_SECONDS)
+def show_backend_status():
+    _, error = _check_backend(HEALTH_CHECK_URL)
+    status_text = "🟢 Backend Connected" if not error else "🔴 Backend Disconnected"
+    st.markdown(f'<div class="status-indicator">{status_text}</div>', unsafe_allow_html=True)
+
+show_backend_status()
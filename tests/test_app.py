@@ -0,0 +1,44 @@
+import json
+from pathlib import Path
+from unittest import mock
+
+from streamlit.testing.v1 import AppTest
+
+APP_PATH = str(Path(__file__).resolve().parent.parent / "app.py")
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.content = json.dumps(payload).encode()
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+
+def run_query(results):
+    # Stub every backend call; /query returns the given rows.
+    def fake_request(session, method, url, **kwargs):
+        if url.endswith("/query"):
+            return FakeResponse({"sql_query": "SELECT * FROM t", "results": results})
+        return FakeResponse({})
+
+    with mock.patch("requests.Session.request", fake_request):
+        at = AppTest.from_file(APP_PATH, default_timeout=30).run()
+        at.chat_input[0].set_value("show me t").run()
+    return at
+
+
+def test_query_with_bigint_unsigned_ids():
+    at = run_query([{"id": 2**63}, {"id": 1}])
+    assert not at.exception
+    assert at.session_state.chat["role"] == ["user", "assistant"]
+    assert at.session_state.chat["result"][1] is not None
+
+
+def test_query_with_ragged_rows_keeps_every_column():
+    at = run_query([{"a": 1}, {"a": 2, "b": 3}])
+    assert not at.exception
+    assert set(at.session_state.chat["result"][1].columns) == {"a", "b"}